@@ -1,7 +1,28 @@
 import re
-import numpy as np
-import matplotlib.pyplot as plt
-import stargazer
+import gc
+import warnings
+import pickle
+import functools
+import concurrent.futures
+import multiprocessing
+import itertools
+from pathlib import Path
+from concurrent.futures.process import BrokenProcessPool
+
+# Patterns and translation table used by clean_filename, built once at import
+_NON_WORD = re.compile(r'\W+')
+_MULTI_UNDERSCORE = re.compile(r'_+')
+_FILENAME_TRANSLATION = str.maketrans({' ': '_', '/': '_over_'})
+
+# Number of figures saved by savefig, used to trigger periodic garbage collection
+_GC_EVERY_N_FIGURES = 50
+_saved_figure_count = 0
+
+# File formats savefig can write
+_FIGURE_FORMATS = ('pdf', 'png')
+
+# Worker process used by savefig to write figures in the background, created on first use
+_figure_executor = None
 
 def Capitalize(string):
     """
@@ -17,6 +38,8 @@ def Capitalize(string):
     str
         The string with the first letter capitalized.
     """
+    if not string or string[0].isupper():
+        return string
     return string[0].capitalize() + string[1:]
 
 def clean_filename(filename):
@@ -34,10 +57,9 @@ def clean_filename(filename):
     str
         The cleaned filename.
     """
-    filename = filename.lower().replace(' ', '_')
-    filename = filename.replace('/', '_over_')
-    filename = re.sub(r'\W+', '', filename)
-    filename = re.sub('_+', '_', filename)
+    filename = filename.lower().translate(_FILENAME_TRANSLATION)
+    filename = _NON_WORD.sub('', filename)
+    filename = _MULTI_UNDERSCORE.sub('_', filename)
     return filename
 
 def generate_lower_order_interactions(vars_in_interaction):
@@ -50,21 +72,10 @@ def generate_lower_order_interactions(vars_in_interaction):
     Returns:
         lower_order_interactions (list): A list of all lower-order interaction terms.
     """
-    lower_order_interactions = []
-
-    # For each index, generate interaction terms by leaving out one term at a time
-    for i in range(len(vars_in_interaction)):
-        lower_order = vars_in_interaction[:i] + vars_in_interaction[(i+1):]
-
-        # Add interaction term to list
-        if lower_order:  # only if there is something left
-            lower_order_interactions.append(':'.join(lower_order))
-
-        # If there are more than two variables left, generate lower-order interactions recursively
-        if len(lower_order) > 1:
-            lower_order_interactions.extend(generate_lower_order_interactions(lower_order))
-
-    return lower_order_interactions
+    # Every non-empty proper subset of the variables is a lower-order interaction
+    return [':'.join(combination)
+            for order in range(1, len(vars_in_interaction))
+            for combination in itertools.combinations(vars_in_interaction, order)]
 
 
 def generate_covariate_latexdict(latexdict, cov_names):
@@ -81,6 +92,11 @@ def generate_covariate_latexdict(latexdict, cov_names):
     # Initialize the output dictionary
     cov_latexdict = {}
 
+    # Precompute the position of each variable in latexdict and the set of covariate names
+    key_index = {var: i for i, var in enumerate(latexdict)}
+    unknown_var_index = -len(latexdict) # sorts variables missing from latexdict last
+    cov_names_set = set(cov_names)
+
     # For each covariate name
     for cov_name in cov_names:
         # Split the covariate name into its constituent variables
@@ -89,13 +105,13 @@ def generate_covariate_latexdict(latexdict, cov_names):
         # If the covariate is an interaction term
         if len(vars_in_interaction) > 1:
             # Generate all lower-order interactions
-            lower_order_interactions = generate_lower_order_interactions(vars_in_interaction)
+            lower_order_interactions = set(generate_lower_order_interactions(vars_in_interaction))
             # Check that all lower-order interactions are included
-            assert set(lower_order_interactions).issubset(cov_names), \
+            assert lower_order_interactions.issubset(cov_names_set), \
                 f"Not all lower-order interactions of '{cov_name}' are included. " \
-                f"Missing interactions: {set(lower_order_interactions) - set(cov_names)}"
+                f"Missing interactions: {lower_order_interactions - cov_names_set}"
             # Sort vars_in_interaction based on the order of variables in latexdict.keys()
-            correct_order_vars = sorted(vars_in_interaction, key=lambda var: -list(latexdict.keys()).index(var) if var in latexdict.keys() else np.inf)
+            correct_order_vars = sorted(vars_in_interaction, key=lambda var: -key_index.get(var, unknown_var_index))
             # If the order is not correct, raise an assertion error
             assert vars_in_interaction == correct_order_vars, \
                 f"Variable order in '{cov_name}' does not match the order in latexdict. " \
@@ -145,7 +161,7 @@ def savereg(stargazer, filename, tablepath, latexdict, adjustwidth='auto', debug
     stargazer.rename_covariates(cov_latexdict)
 
     # Overwrite R2 with pseudo-R2 if provided
-    if any([hasattr(model, 'prsquasecond') for model in stargazer.models]):
+    if any(hasattr(model, 'prsquasecond') for model in stargazer.models):
         for model, model_data in zip(stargazer.models, stargazer.model_data):
             model_data['r2'] = model.prsquasecond                        
             if not "$R^2$ reports McFadden's pseudo-$R^2$." in stargazer.custom_notes:
@@ -153,49 +169,194 @@ def savereg(stargazer, filename, tablepath, latexdict, adjustwidth='auto', debug
     
     # Render table to LaTeX and do post-processing
     latex = stargazer.render_latex()
-    latex = latex.replace('nan', '')
-    latex = latex.replace('\cline{'+str(stargazer.num_models)+'-'+str(stargazer.num_models+1)+'}', '\cline{2-'+str(stargazer.num_models+1)+'}')
+    fixups = {
+        'nan': '',
+        '\\cline{'+str(stargazer.num_models)+'-'+str(stargazer.num_models+1)+'}': '\\cline{2-'+str(stargazer.num_models+1)+'}',
+    }
     if adjustwidth:
-        latex = latex.replace('\\begin{tabular}', '\\begin{adjustbox}{width=\linewidth}\\begin{tabular}')
-        latex = latex.replace('\end{tabular}', '\end{tabular}\end{adjustbox}')
+        fixups['\\begin{tabular}'] = '\\begin{adjustbox}{width=\\linewidth}\\begin{tabular}'
+        fixups['\\end{tabular}'] = '\\end{tabular}\\end{adjustbox}'
+    # Apply all replacements in a single pass over the rendered table
+    fixup_pattern = re.compile('|'.join(map(re.escape, fixups)))
+    latex = fixup_pattern.sub(lambda match: fixups[match.group(0)], latex)
     
     # Write the full table to a .tex file
-    with open(tablepath+filename+'.tex', 'w') as f: 
-        f.write(latex)
+    tablefile = tablepath+filename
+    Path(tablefile+'.tex').write_text(latex)
     if debug:
-        print('Saved as: '+tablepath+filename+'.tex')
+        print('Saved as: '+tablefile+'.tex')
 
     # Write only the tabular part of the table to a .tex file
-    latex_table = latex.partition("\\begin{tabular}")[1] + latex.partition("\\begin{tabular}")[2]
-    latex_table = latex_table.partition("\end{tabular}")[0] + latex_table.partition("\end{tabular}")[1]
-    with open(tablepath+filename+'_tabular.tex', 'w') as f: 
-        f.write(latex_table)
+    _, begin, rest = latex.partition("\\begin{tabular}")
+    body, end, _ = rest.partition("\\end{tabular}")
+    latex_table = begin + body + end
+    Path(tablefile+'_tabular.tex').write_text(latex_table)
+
+def _get_titles(ax):
+    """
+    Get the visible, non-empty title of an axes and the suptitle of its figure.
+
+    Args:
+        ax (matplotlib.axes.Axes): Axes object to get the titles for.
+
+    Returns:
+        titles (list): The title text artists, empty if neither title is shown.
+    """
+    suptitle = getattr(ax.get_figure(), '_suptitle', None)
+    return [title for title in (ax.title, suptitle)
+            if title is not None and title.get_visible() and title.get_text()]
+
+def _get_figure_executor():
+    """
+    Return the worker process pool used for background figure writing, creating it on first use.
+    """
+    global _figure_executor
+    if _figure_executor is None:
+        # Avoid fork, which can deadlock when the calling process runs threads (e.g. Jupyter or GUI backends)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _figure_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context(start_method))
+    return _figure_executor
+
+def _discard_figure_executor():
+    """
+    Shut down and forget the worker process pool, e.g. after its worker died, so the next use creates a new one.
+    """
+    global _figure_executor
+    if _figure_executor is not None:
+        _figure_executor.shutdown(wait=False)
+        _figure_executor = None
+
+def _write_figure(fig, targets):
+    """
+    Write a figure to each of the given targets.
+
+    Args:
+        fig (matplotlib.figure.Figure): Figure to write.
+        targets (list): List of (path, savefig keyword arguments) tuples.
+    """
+    for path, kwargs in targets:
+        fig.savefig(path, **kwargs)
 
-def savefig(ax, filename, figurepath):
+def _write_pickled_figure(figure_bytes, targets):
     """
-    Function to save a figure to a .pdf and .png file.
+    Unpickle a figure in a worker process, write it to each of the given targets and close it.
+    """
+    import matplotlib.pyplot as plt
+
+    fig = pickle.loads(figure_bytes)
+    _write_figure(fig, targets)
+    plt.close(fig)
+
+def _dispatch_figure_write(fig, targets, background):
+    """
+    Write a figure either inline or, if background is True, in the worker process.
+
+    The figure is pickled at the time of the call, so it can be modified or closed afterwards. If the worker
+    process has died, the pool is discarded and the figure is written inline instead.
+
+    Returns:
+        concurrent.futures.Future or None: The pending background write, or None if written inline.
+    """
+    if background:
+        try:
+            return _get_figure_executor().submit(_write_pickled_figure, pickle.dumps(fig), targets)
+        except BrokenProcessPool:
+            _discard_figure_executor()
+            warnings.warn("The background figure worker died, writing the figure inline instead.")
+    _write_figure(fig, targets)
+    return None
+
+def _report_figure_write(path, announce, future):
+    """
+    Done-callback for a background figure write, warning if it failed.
+
+    Args:
+        path (str): Path of the main file written by the task.
+        announce (bool): If True, prints where the figure was saved once the write succeeded.
+        future (concurrent.futures.Future): The finished background write.
+    """
+    exception = future.exception()
+    if exception is not None:
+        warnings.warn(f"Saving figure to '{path}' failed: {exception!r}")
+    elif announce:
+        print('Saved to: '+path)
+
+def savefig(ax, filename, figurepath, formats=('pdf', 'png'), png_dpi=500, show=True, background=False):
+    """
+    Function to save a figure to a .pdf and/or .png file.
 
     Args:
         ax (matplotlib.axes.Axes): Axes object representing the figure to save.
         filename (str): Name of the file to save the figure as.
         figurepath (str): The path to save the figure in.
+        formats (tuple, optional): File formats to save, any of 'pdf' and 'png'. The version without title
+            is only saved as .pdf. Raises a ValueError for any other format. Defaults to ('pdf', 'png').
+        png_dpi (int, optional): Resolution of the .png file. Defaults to 500.
+        show (bool, optional): If True, shows the figure before closing it. Defaults to True.
+        background (bool, optional): If True, the files are written by a worker process and the function
+            returns without waiting for them. Where the figure was saved is printed, or a warning issued if
+            writing failed, once the worker is done. The worker is not forked, so scripts using this need an
+            `if __name__ == '__main__':` guard. Set to False to write inline, e.g. for debugging.
+            Defaults to False.
+
+    Returns:
+        futures (list): Pending background writes, empty if background is False.
     """
+    global _saved_figure_count
+
+    # Check the requested formats, so that a typo does not silently discard the figure
+    if isinstance(formats, str):
+        raise ValueError(f"formats must be a tuple of formats, e.g. ('{formats}',), not a string.")
+    unsupported_formats = set(formats) - set(_FIGURE_FORMATS)
+    if unsupported_formats:
+        raise ValueError(f"Unsupported figure formats: {sorted(unsupported_formats)}. "
+                         f"Supported formats are: {list(_FIGURE_FORMATS)}.")
+
+    import matplotlib.pyplot as plt
+
     # Cleans the filename using predefined helper function
     filename = clean_filename(filename)
+    fig = ax.get_figure()
+    futures = []
+
+    # If the axes or the figure show a title, hide it for an additional version without title
+    titles = _get_titles(ax)
+    if titles and 'pdf' in formats:
+        visibilities = [title.get_visible() for title in titles]
+        plt.setp(titles, visible=False)
+        try:
+            notitle_path = figurepath+filename+'_notitle.pdf'
+            future = _dispatch_figure_write(fig, [(notitle_path, dict(bbox_inches='tight'))], background)
+            if future is not None:
+                future.add_done_callback(functools.partial(_report_figure_write, notitle_path, False))
+                futures.append(future)
+        finally:
+            # Restore the titles' original visibility
+            for title, visible in zip(titles, visibilities):
+                title.set_visible(visible)
+
+    # Save the figure with title in the requested formats
+    targets = []
+    if 'pdf' in formats:
+        targets.append((figurepath+filename+'.pdf', dict(bbox_inches='tight')))
+    if 'png' in formats:
+        targets.append((figurepath+filename+'.png', dict(facecolor='w', dpi=png_dpi, bbox_inches='tight')))
+    if targets:
+        future = _dispatch_figure_write(fig, targets, background)
+        if future is not None:
+            # Announce the file only once the worker has written it
+            future.add_done_callback(functools.partial(_report_figure_write, targets[0][0], True))
+            futures.append(future)
+    if show:
+        plt.show() # Show the plot
+    if targets and future is None:
+        print('Saved to: '+targets[0][0])
+
+    # Close the figure to release its memory and collect garbage periodically in batch runs
+    plt.close(fig)
+    _saved_figure_count += 1
+    if _saved_figure_count % _GC_EVERY_N_FIGURES == 0:
+        gc.collect()
 
-    # Check if ax has title attribute and hide it for saving if so
-    if hasattr(ax, 'title'):
-        plt.setp(ax.title, visible=False)
-        plt.savefig(figurepath+filename+'_notitle.pdf', bbox_inches='tight')
-        plt.setp(ax.title, visible=True) # Make the title visible again
-    # Check if ax has suptitle attribute and hide it for saving if so
-    elif hasattr(ax, 'suptitle'):
-        plt.setp(ax.title, visible=False)
-        plt.savefig(figurepath+filename+'_notitle.pdf', bbox_inches='tight')
-        plt.setp(ax.title, visible=True) # Make the title visible again
-
-    # Save the figure with title as .pdf and .png
-    plt.savefig(figurepath+filename+'.pdf', bbox_inches='tight')
-    plt.savefig(figurepath+filename+'.png', facecolor='w', dpi=500, bbox_inches='tight')
-    plt.show() # Show the plot
-    print('Saved to: '+figurepath+filename+'.pdf')
\ No newline at end of file
+    return futures